@@ -1,35 +1,36 @@
 from langchain_community.document_loaders import TextLoader
-from langchain.text_splitter import CharacterTextSplitter,TokenTextSplitter, RecursiveCharacterTextSplitter, NLTKTextSplitter
+from langchain.text_splitter import RecursiveCharacterTextSplitter
 
 from langchain.vectorstores import FAISS
-from langchain.embeddings import OpenAIEmbeddings,SentenceTransformerEmbeddings
-from langchain import hub
+from langchain.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores.utils import DistanceStrategy
+from langchain.embeddings import SentenceTransformerEmbeddings
 import nltk
 
 from langchain_core.output_parsers import StrOutputParser
-from langchain.schema.runnable.passthrough import RunnableAssign
-from operator import itemgetter
+from langchain_core.embeddings import Embeddings
+from langchain_core.documents import Document
 
 from langchain.prompts import ChatPromptTemplate
 
 from langchain_anthropic import ChatAnthropic
 
+import faiss
+import hashlib
+import itertools
+import json
+import logging
+import mmap
+import multiprocessing
 import numpy as np
 import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from dotenv import load_dotenv
-from langchain_chroma import Chroma
-
-import langroid as lr
-from langroid.mytypes import Document
-from langroid.mytypes import DocMetaData
-from langroid.parsing.parser import ParsingConfig
-from langroid.agent.special.doc_chat_agent import DocChatAgent, DocChatAgentConfig
-from langroid.vector_store import QdrantDBConfig, ChromaDBConfig
-from langroid.embedding_models import OpenAIEmbeddingsConfig
-from langroid.utils.configuration import Settings, set_global
-from langroid.embedding_models.models import SentenceTransformerEmbeddingsConfig
 
 load_dotenv()
+
+logger = logging.getLogger(__name__)
 os.environ["ANTHROPIC_API_KEY"] = os.getenv("ANTHROPIC_API_KEY")
 os.environ["OPENAI_API_KEY"] = os.getenv("OPENAI_API_KEY")
 
@@ -42,25 +43,358 @@ files = [
 ]
 
 
-nltk.download('punkt')
-loader = TextLoader(files[0]["path"])
-pages = loader.load_and_split()
-
-text_splitter  = RecursiveCharacterTextSplitter(
-    chunk_size=2000,  # The number of tokens in each chunk
-    chunk_overlap=200,  # The number of tokens to overlap between chunks
+CHUNK_SIZE = 512  # The number of tokens in each chunk
+CHUNK_OVERLAP = 64  # The number of tokens to overlap between chunks
+TOKEN_ENCODING = "cl100k_base"
+# Lengths are measured in tiktoken tokens rather than characters so chunks pack evenly
+text_splitter  = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+    encoding_name=TOKEN_ENCODING,
+    chunk_size=CHUNK_SIZE,
+    chunk_overlap=CHUNK_OVERLAP,
 )
-docs = text_splitter.split_documents(pages)
-for i, doc in enumerate(docs):
-    doc.metadata = {"source": f"{i+1}"}
 
 # vectorstore = FAISS.from_documents(documents=docs, embedding=OpenAIEmbeddings(openai_api_key=""))
 # embedding_model = SentenceTransformerEmbeddings(model_name="jinaai/jina-embedding-l-en-v1")
 
-embedding_model = SentenceTransformerEmbeddings(model_name="BAAI/bge-m3")
+EMBED_BATCH_SIZE = 64
+# Processes used to embed the corpus at index-build time on CPU hosts; 1 encodes in-process
+EMBED_WORKERS = int(os.getenv("EMBED_WORKERS", "1"))
+# Path to an int8-quantized ONNX export of BGE-M3 (see quantize_onnx_model); unset keeps PyTorch FP32
+BGE_ONNX_MODEL = os.getenv("BGE_ONNX_MODEL")
+
+
+class OnnxBgeEmbeddings(Embeddings):
+    """
+    BGE-M3 dense embeddings computed with ONNX Runtime from a (quantized) ONNX export.
+    Uses CLS pooling, as BGE-M3 does for dense retrieval.
+    """
+
+    def __init__(self, model_path, tokenizer_name="BAAI/bge-m3", max_length=512):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        providers = ["CPUExecutionProvider"]
+        if "CUDAExecutionProvider" in ort.get_available_providers():
+            providers.insert(0, "CUDAExecutionProvider")
+        self.session = ort.InferenceSession(model_path, providers=providers)
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_name, use_fast=True)
+        self.max_length = max_length
+
+    def encode(self, texts, batch_size=EMBED_BATCH_SIZE, **kwargs):
+        batches = []
+        for start in range(0, len(texts), batch_size):
+            enc = self.tokenizer(texts[start:start + batch_size], padding=True, truncation=True,
+                                 max_length=self.max_length, return_tensors="np")
+            batches.append(self.encode_ids(enc["input_ids"], enc["attention_mask"]))
+        return np.concatenate(batches).astype("float32")
+
+    def encode_ids(self, input_ids, attention_mask):
+        """
+        CLS embeddings for an already tokenized, padded batch.
+        """
+        enc = {"input_ids": input_ids, "attention_mask": attention_mask}
+        feeds = {name: enc[name].astype(np.int64) for name in self.input_names if name in enc}
+        last_hidden_state = self.session.run(None, feeds)[0]
+        return last_hidden_state[:, 0]
+
+    def embed_documents(self, texts):
+        return self.encode(texts).tolist()
+
+    def embed_query(self, text):
+        return self.encode([text])[0].tolist()
+
+
+def quantize_onnx_model(onnx_path, quantized_path):
+    """
+    Dynamic int8 quantization of an ONNX export of BGE-M3, e.g. one produced by
+    `optimum-cli export onnx --model BAAI/bge-m3 bge_onnx/`.
+    """
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    quantize_dynamic(onnx_path, quantized_path, weight_type=QuantType.QInt8)
+
+
+if BGE_ONNX_MODEL:
+    embedding_model = OnnxBgeEmbeddings(BGE_ONNX_MODEL)
+    encoder = embedding_model
+else:
+    embedding_model = SentenceTransformerEmbeddings(model_name="BAAI/bge-m3", encode_kwargs={"normalize_embeddings": True})
+    encoder = embedding_model.client
+
+# IVF256 coarse quantizer + 32 sub-quantizers of 8 bits each (32 bytes per vector).
+# Prefix with "OPQ32_256," for better recall at the same code size.
+IVFPQ_FACTORY = "IVF256,PQ32x8"
+IVF_NPROBE = 8
+# k-means wants ~39 training points per centroid; smaller corpora use an HNSW graph instead
+IVFPQ_MIN_TRAIN = 39 * 256
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 64
+HNSW_EF_SEARCH = 32
+INDEX_DIR = "faiss_index"
+INDEX_PATH = os.path.join(INDEX_DIR, "index.faiss")
+META_PATH = os.path.join(INDEX_DIR, "meta.json")
+TOKENS_PATH = os.path.join(INDEX_DIR, "tokens.npz")
+
+
+def embed_texts(texts, show_progress_bar=False):
+    """
+    Encode all texts in one batched call on the underlying encoder
+    instead of going through LangChain's embed_documents. Rows are L2-normalised
+    so inner product equals cosine similarity.
+    """
+    embs = encoder.encode(
+        texts,
+        batch_size=EMBED_BATCH_SIZE,
+        convert_to_numpy=True,
+        show_progress_bar=show_progress_bar,
+    ).astype("float32")
+    faiss.normalize_L2(embs)
+    return embs
+
+
+def tokenize_corpus(texts):
+    """
+    BGE-M3 input ids of the chunks as one flat int32 array plus row offsets. They are cached in
+    TOKENS_PATH keyed on the texts, so re-embedding unchanged chunks (e.g. after switching the
+    encoder or index type) skips the tokenizer entirely.
+    """
+    tokenizer = encoder.tokenizer
+    max_length = getattr(encoder, "max_seq_length", None) or encoder.max_length
+    key = hashlib.sha256("\0".join([str(max_length), *texts]).encode("utf-8")).hexdigest()
+    if os.path.exists(TOKENS_PATH):
+        cached = np.load(TOKENS_PATH)
+        if str(cached["key"]) == key:
+            return cached["ids"], cached["offsets"]
+
+    input_ids = tokenizer(texts, truncation=True, max_length=max_length)["input_ids"]
+    offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+    np.cumsum([len(row) for row in input_ids], out=offsets[1:])
+    ids = np.fromiter(itertools.chain.from_iterable(input_ids), dtype=np.int32, count=int(offsets[-1]))
+    os.makedirs(INDEX_DIR, exist_ok=True)
+    np.savez(TOKENS_PATH, key=key, ids=ids, offsets=offsets)
+    return ids, offsets
+
+
+def pad_token_batch(ids, offsets, pad_id):
+    """
+    Dense (input_ids, attention_mask) for the rows delimited by offsets, padded to the longest row.
+    """
+    lengths = np.diff(offsets)
+    input_ids = np.full((len(lengths), lengths.max()), pad_id, dtype=np.int64)
+    attention_mask = np.zeros_like(input_ids)
+    for row, (begin, length) in enumerate(zip(offsets[:-1], lengths)):
+        input_ids[row, :length] = ids[begin:begin + length]
+        attention_mask[row, :length] = 1
+    return input_ids, attention_mask
+
+
+def embed_token_ids(ids, offsets):
+    """
+    Embed pre-tokenized chunks (see tokenize_corpus) by feeding the ids straight to the model,
+    bypassing the tokenizer inside encode. Rows are L2-normalised like embed_texts.
+    """
+    pad_id = encoder.tokenizer.pad_token_id
+    batches = []
+    for start in range(0, len(offsets) - 1, EMBED_BATCH_SIZE):
+        input_ids, attention_mask = pad_token_batch(ids, offsets[start:start + EMBED_BATCH_SIZE + 1], pad_id)
+        if BGE_ONNX_MODEL:
+            batches.append(encoder.encode_ids(input_ids, attention_mask))
+        else:
+            import torch
+
+            features = {
+                "input_ids": torch.from_numpy(input_ids).to(encoder.device),
+                "attention_mask": torch.from_numpy(attention_mask).to(encoder.device),
+            }
+            with torch.inference_mode():
+                batches.append(encoder(features)["sentence_embedding"].float().cpu().numpy())
+    embs = np.concatenate(batches).astype("float32")
+    faiss.normalize_L2(embs)
+    return embs
+
+
+def set_search_params(index):
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+    else:
+        faiss.ParameterSpace().set_index_parameter(index, "nprobe", IVF_NPROBE)
+
+
+# Token ids of the corpus being embedded, set just before the embed workers fork so each one
+# reads the parent's array copy-on-write instead of receiving a pickled copy with every shard
+_corpus_ids = None
+
+
+def _embed_shard(offsets):
+    return embed_token_ids(_corpus_ids, offsets)
+
+
+def _init_embed_worker():
+    import torch
+
+    # split the cores between workers instead of every worker spawning os.cpu_count() threads
+    torch.set_num_threads(max(1, os.cpu_count() // EMBED_WORKERS))
+
+
+def embed_corpus(texts):
+    """
+    Embed the corpus for an index build from its cached token ids. With EMBED_WORKERS > 1 the
+    chunks are sharded across forked worker processes that share the already-loaded encoder and
+    the token ids copy-on-write; only each shard's offsets are sent to a worker.
+    The pool is forked here, during the index build at import, before the parent has run any
+    torch compute, so no OpenMP thread pool is inherited half-initialised; the workers size
+    their own in _init_embed_worker. (A spawn context would re-import this module, and with it
+    the index build, in every worker.) ONNX Runtime already spreads a batch over all cores,
+    so the ONNX encoder stays in-process.
+    """
+    global _corpus_ids
+    ids, offsets = tokenize_corpus(texts)
+    if EMBED_WORKERS <= 1 or BGE_ONNX_MODEL:
+        return embed_token_ids(ids, offsets)
+
+    shard_size = -(-len(texts) // EMBED_WORKERS)
+    shards = [offsets[i:i + shard_size + 1] for i in range(0, len(texts), shard_size)]
+    _corpus_ids = ids
+    try:
+        with ProcessPoolExecutor(EMBED_WORKERS, mp_context=multiprocessing.get_context("fork"),
+                                 initializer=_init_embed_worker) as executor:
+            return np.concatenate(list(executor.map(_embed_shard, shards)))
+    finally:
+        _corpus_ids = None
+
+
+def build_faiss_index(xb):
+    """
+    Build an IVFPQ index over the chunk embeddings, or an HNSW graph (no training
+    needed, sub-linear search) when the corpus is too small to train the IVF and PQ quantizers.
+    """
+    if len(xb) < IVFPQ_MIN_TRAIN:
+        index = faiss.IndexHNSWFlat(xb.shape[1], HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    else:
+        index = faiss.index_factory(xb.shape[1], IVFPQ_FACTORY, faiss.METRIC_INNER_PRODUCT)
+        index.train(xb)
+    index.add(xb)
+    set_search_params(index)
+    return index
+
+
+def corpus_fingerprint(path):
+    """
+    Hash of the corpus file plus the chunking/index settings; a cached index is
+    only reused when both are unchanged.
+    """
+    digest = hashlib.sha256()
+    # Hash through a read-only mapping so the corpus is never copied into a Python bytes object
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        digest.update(m)
+    digest.update(f"{TOKEN_ENCODING}:{CHUNK_SIZE}:{CHUNK_OVERLAP}:{IVFPQ_FACTORY}:HNSW{HNSW_M}:IP:{BGE_ONNX_MODEL}".encode())
+    return digest.hexdigest()
+
+
+def split_corpus(path):
+    try:
+        nltk.data.find('tokenizers/punkt')
+    except LookupError:
+        nltk.download('punkt')
+    loader = TextLoader(path)
+    pages = loader.load_and_split()
+    docs = text_splitter.split_documents(pages)
+    for i, doc in enumerate(docs):
+        doc.metadata = {"source": f"{i+1}"}
+    return docs
+
+
+def load_vectorstore(path, fingerprint):
+    """
+    Load the FAISS index and chunks from INDEX_DIR, rebuilding them only when
+    the corpus (or chunking settings) changed since the last build.
+    """
+    meta = None
+    if os.path.exists(INDEX_PATH) and os.path.exists(META_PATH):
+        with open(META_PATH, "r") as f:
+            meta = json.load(f)
+
+    if meta is not None and meta["sha256"] == fingerprint:
+        # IO_FLAG_MMAP only maps the inverted lists of an IVF index (large corpora), which then
+        # stay in the page cache shared by the workers; the HNSW index used for corpora below
+        # IVFPQ_MIN_TRAIN, like the chunk texts from META_PATH, is still read into each process
+        index = faiss.read_index(INDEX_PATH, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        set_search_params(index)
+        # One Document per stored chunk, so docstore ids line up with the FAISS rows
+        docs = [Document(page_content=text, metadata=metadata)
+                for text, metadata in zip(meta["texts"], meta["metadatas"])]
+    else:
+        docs = split_corpus(path)
+        texts = [doc.page_content for doc in docs]
+        xb = embed_corpus(texts)
+        index = build_faiss_index(xb)
+        os.makedirs(INDEX_DIR, exist_ok=True)
+        faiss.write_index(index, INDEX_PATH)
+        with open(META_PATH, "w") as f:
+            json.dump({"sha256": fingerprint, "texts": texts, "metadatas": [doc.metadata for doc in docs]}, f)
+
+    return FAISS(
+        embedding_function=embedding_model,
+        index=index,
+        docstore=InMemoryDocstore({str(i): doc for i, doc in enumerate(docs)}),
+        index_to_docstore_id={i: str(i) for i in range(len(docs))},
+        normalize_L2=True,
+        distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+    )
+
 
-# Create the Chroma vector store and add documents
-vectorstore = FAISS.from_documents(documents=docs, embedding=embedding_model)
+class SemanticCache:
+    """
+    Previous answers keyed by the (normalised) query embedding. A lookup hits
+    when the cosine similarity to a cached query reaches `threshold`, so
+    paraphrased repeats skip retrieval and the Claude call.
+    """
+
+    def __init__(self, dim, fingerprint, threshold=0.95, path=os.path.join(INDEX_DIR, "semantic_cache"), save_every=20):
+        self.fingerprint = fingerprint
+        self.threshold = threshold
+        self.index_path = path + ".faiss"
+        self.responses_path = path + ".json"
+        self.save_every = save_every
+        self._unsaved = 0
+        self.index = faiss.IndexFlatIP(dim)
+        self.responses = []
+        if os.path.exists(self.index_path) and os.path.exists(self.responses_path):
+            with open(self.responses_path, "r") as f:
+                saved = json.load(f)
+            # answers cached against an older corpus are dropped
+            if saved["sha256"] == fingerprint:
+                self.index = faiss.read_index(self.index_path)
+                self.responses = saved["responses"]
+
+    def lookup(self, q_emb):
+        if self.index.ntotal == 0:
+            return None
+        scores, ids = self.index.search(q_emb, 1)
+        if scores[0][0] >= self.threshold:
+            return self.responses[ids[0][0]]
+        return None
+
+    def add(self, q_emb, response):
+        self.index.add(q_emb)
+        self.responses.append(response)
+        self._unsaved += 1
+        if self._unsaved >= self.save_every:
+            self.save()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        faiss.write_index(self.index, self.index_path)
+        with open(self.responses_path, "w") as f:
+            json.dump({"sha256": self.fingerprint, "responses": self.responses}, f)
+        self._unsaved = 0
+
+
+fingerprint = corpus_fingerprint(files[0]["path"])
+vectorstore = load_vectorstore(files[0]["path"], fingerprint)
+semantic_cache = SemanticCache(vectorstore.index.d, fingerprint)
 
 # vectorstore = Chroma.from_documents(
 #     documents=docs,
@@ -72,11 +406,39 @@ vectorstore = FAISS.from_documents(documents=docs, embedding=embedding_model)
 
 retriever = vectorstore.as_retriever()
 
-llm = ChatAnthropic(model="claude-3-haiku-20240307", temperature=1)
+SHINGLE_SIZE = 5
+SIMHASH_MAX_DISTANCE = 3
+
+
+def simhash(text):
+    """
+    64-bit simhash over 5-word shingles; overlapping chunks of the same passage land a few bits apart.
+    """
+    words = text.split()
+    shingles = [" ".join(words[i:i + SHINGLE_SIZE]) for i in range(max(len(words) - SHINGLE_SIZE + 1, 1))]
+    weights = [0] * 64
+    for shingle in shingles:
+        h = int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(64):
+            weights[bit] += 1 if h >> bit & 1 else -1
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
 
 def format_docs(docs):
-    formatted_docs =  "\n\n".join(doc.page_content for doc in docs)
-    sources = [doc.metadata.get("source", "unknown") for doc in docs]
+    """
+    Join the retrieved chunks for the prompt, dropping near-duplicates (simhash within
+    SIMHASH_MAX_DISTANCE bits of a chunk already kept). No token cap: the retriever's k chunks
+    of at most CHUNK_SIZE tokens each already bound the context.
+    """
+    kept, hashes = [], []
+    for doc in docs:
+        h = simhash(doc.page_content)
+        if any(bin(h ^ seen).count("1") <= SIMHASH_MAX_DISTANCE for seen in hashes):
+            continue
+        hashes.append(h)
+        kept.append(doc)
+    formatted_docs = "\n\n".join(doc.page_content for doc in kept)
+    sources = [doc.metadata.get("source", "unknown") for doc in kept]
     return formatted_docs,sources
 
 prompt = ChatPromptTemplate.from_messages(
@@ -105,20 +467,17 @@ Please make the responses elaborate.
     ]
 )
 
-response_generator = (prompt | llm | StrOutputParser()).with_config(
-    run_name="GenerateResponse",
-)
 
-chain = (
-    RunnableAssign(
-        {
-            "context": (itemgetter("question") | retriever | format_docs).with_config(
-                run_name="FormatDocs"
-            )
-        }
+@lru_cache(maxsize=None)
+def get_response_generator():
+    """
+    Build the prompt | Claude | parser pipeline on first use instead of at import, and
+    reuse it (and the Anthropic client's keep-alive connection pool) for every later query.
+    """
+    llm = ChatAnthropic(model="claude-3-haiku-20240307", temperature=1)
+    return (prompt | llm | StrOutputParser()).with_config(
+        run_name="GenerateResponse",
     )
-    | response_generator
-)
 
 # embedder = OpenAIEmbeddings(openai_api_key="")
 
@@ -145,31 +504,44 @@ chain = (
 #         time.sleep(5)
 # else:
 #     print("No relevant documents found.")
-def retrieve_context(question):
-    retrieved_docs = retriever.invoke(question)
-    print("\n\nQuestion:", question)
-    for doc in retrieved_docs:
-        print(f"Source: {doc.metadata['source']}")
-        print(f"Content: {doc.page_content[:500]}...") 
-        print("\n")
-    docs = retriever.get_relevant_documents(question)
-    # print("Retrieved Documents:", docs)
+def retrieve_context(question, q_emb=None):
+    """
+    Fetch the chunks for a question; pass q_emb to search with an already computed
+    query embedding instead of embedding the question again.
+    """
+    if q_emb is None:
+        docs = retriever.invoke(question)
+    else:
+        docs = vectorstore.similarity_search_by_vector(q_emb[0], **retriever.search_kwargs)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Question: %s", question)
+        for doc in docs:
+            logger.debug("Source: %s content: %.500s...", doc.metadata["source"], doc.page_content)
     formatted_docs, sources = format_docs(docs)
     return formatted_docs, sources
 
 def process_unstr_query(query): 
     try:
-        context, sources = retrieve_context(query)
+        q_emb = embed_texts([query])
+        cached_response = semantic_cache.lookup(q_emb)
+        if cached_response is not None:
+            return cached_response
+
+        context, sources = retrieve_context(query, q_emb)
         # print("Document Context:", context)
         # print("Document Sources Used:", sources)
-        response = chain.invoke({"question": query})
-        print("Response:", response)
+        response = get_response_generator().invoke({"question": query, "context": context})
+        logger.debug("Response: %s", response)
+        semantic_cache.add(q_emb, response)
         return response
     except Exception as e:
-        print("Error:", e)
+        logger.error("Error: %s", e)
         return "HI! I am experiencing some dizziness. Please give me a few minutes to fix myself."
-query = " what are all the services available ? "
-print(process_unstr_query(query))
+
+
+if __name__ == "__main__":
+    query = " what are all the services available ? "
+    print(process_unstr_query(query))
 # from datetime import datetime
 # current_date = datetime.now()
 # formatted_date = current_date.strftime('%d-%m-%Y')
@@ -1,5 +1,5 @@
 from flask import Flask
-from app.config import load_configurations, configure_logging
+from app.config import load_configurations, configure_logging, configure_json
 from .views import webhook_blueprint
 from .tasks import make_celery
 
@@ -9,6 +9,7 @@ def create_app():
     # Load configurations and logging settings
     load_configurations(app)
     configure_logging()
+    configure_json(app)
 
 
     # Initialize Celery
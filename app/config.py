@@ -2,6 +2,35 @@ import sys
 import os
 from dotenv import load_dotenv
 import logging
+import orjson
+from dataclasses import dataclass
+from flask.json.provider import DefaultJSONProvider
+
+
+@dataclass(frozen=True, slots=True)
+class RagSettings:
+    """
+    RAG server call settings, parsed from the environment once at startup.
+    connect_timeout/read_timeout are seconds; max_retries counts re-sends after a timeout.
+    """
+
+    connect_timeout: float
+    read_timeout: float
+    max_retries: int
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            connect_timeout=float(os.getenv("RAG_CONNECT_TIMEOUT", "3")),
+            # clamped so a typo cannot overflow the socket timeout
+            read_timeout=min(float(os.getenv("RAG_READ_TIMEOUT", "600")), 3600),
+            max_retries=int(os.getenv("RAG_MAX_RETRIES", "0")),
+        )
+
+    @property
+    def timeout(self):
+        # (connect, read) tuple in the shape requests expects
+        return (self.connect_timeout, self.read_timeout)
 
 
 def load_configurations(app):
@@ -19,6 +48,10 @@ def load_configurations(app):
     os.environ["OPENAI_API_KEY"] = os.getenv("OPENAI_API_KEY")
     app.config["CELERY_BROKER_URL"] = os.getenv("CELERY_BROKER_URL")
     app.config["CELERY_RESULT_BACKEND"] = os.getenv("CELERY_RESULT_BACKEND")
+    app.config["RAG"] = RagSettings.from_env()
+    # Local encoder for is_general_question; set to an empty string to classify with Claude instead
+    app.config["GENERAL_QUESTION_MODEL"] = os.getenv(
+        "GENERAL_QUESTION_MODEL", "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2")
 
 
 def configure_logging():
@@ -27,3 +60,40 @@ def configure_logging():
         format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
         stream=sys.stdout,
     )
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider backed by orjson. Keys are sorted when sort_keys is set (Flask's default),
+    and dates, datetimes and dataclasses are passed through to Flask's default() hook so they
+    serialize exactly as before (dates as HTTP dates). Differences from the stdlib provider:
+    output is always compact (no pretty-printing in debug) and non-ASCII text is emitted as
+    UTF-8 rather than \\u escapes, regardless of ensure_ascii.
+    """
+
+    def _options(self, sort_keys):
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return option
+
+    def dumps(self, obj, **kwargs):
+        option = self._options(kwargs.get("sort_keys", self.sort_keys))
+        return orjson.dumps(obj, default=kwargs.get("default", self.default), option=option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # Same argument handling as flask's jsonify(): one positional value, several (as a list)
+        # or keyword arguments (as a dict)
+        if args and kwargs:
+            raise TypeError("app.json.response() takes either args or kwargs, not both")
+        obj = (args[0] if len(args) == 1 else args or kwargs) if args or kwargs else None
+        # Build the body as bytes directly instead of str -> bytes
+        body = orjson.dumps(obj, default=self.default, option=self._options(self.sort_keys))
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+
+def configure_json(app):
+    app.json = OrjsonProvider(app)
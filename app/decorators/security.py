@@ -1,4 +1,4 @@
-from functools import wraps
+from functools import wraps, lru_cache
 from flask import current_app, jsonify, request
 import logging
 import hashlib
@@ -6,19 +6,27 @@ import hmac
 import time
 from flask import request, abort
 
+from ..utils.json_responses import json_response, INVALID_SIGNATURE_BODY, INVALID_TIMESTAMP_BODY
 
 
+@lru_cache(maxsize=None)
+def primed_hmac(secret):
+    """
+    HMAC-SHA256 object with the key schedule for the given secret already applied.
+    Callers must .copy() it before updating so the inner/outer key pads are only derived once.
+    """
+    return hmac.new(bytes(secret, "latin-1"), digestmod=hashlib.sha256)
+
 
 def validate_signature(payload, signature):
     """
-    Validate the incoming payload's signature against our expected signature
+    Validate the incoming payload's signature against our expected signature.
+    The payload is the raw request body as bytes, exactly as Meta signed it.
     """
     # Use the App Secret to hash the payload
-    expected_signature = hmac.new(
-        bytes(current_app.config["APP_SECRET"], "latin-1"),
-        msg=payload.encode("utf-8"),
-        digestmod=hashlib.sha256,
-    ).hexdigest()
+    mac = primed_hmac(current_app.config["APP_SECRET"]).copy()
+    mac.update(payload)
+    expected_signature = mac.hexdigest()
 
     # Check if the signature matches
     return hmac.compare_digest(expected_signature, signature)
@@ -34,9 +42,9 @@ def whatsapp_signature_required(f):
         signature = request.headers.get("X-Hub-Signature-256", "")[
             7:
         ]  # Removing 'sha256='
-        if not validate_signature(request.data.decode("utf-8"), signature):
+        if not validate_signature(request.get_data(), signature):
             logging.info("Signature verification failed!")
-            return jsonify({"status": "error", "message": "Invalid signature"}), 403
+            return json_response(INVALID_SIGNATURE_BODY, 403)
         return f(*args, **kwargs)
 
     return decorated_function
@@ -46,13 +54,10 @@ def validate_slack_signature(payload, slack_signature, timestamp):
     """
     Validate the incoming payload's signature against the expected signature.
     """
-    signing_secret = bytes(current_app.config["SLACK_SIGNING_SECRET"], "latin-1")
     sig_basestring = f"v0:{timestamp}:{payload}"
-    expected_signature = 'v0=' + hmac.new(
-        signing_secret,
-        msg=sig_basestring.encode("utf-8"),
-        digestmod=hashlib.sha256
-    ).hexdigest()
+    mac = primed_hmac(current_app.config["SLACK_SIGNING_SECRET"]).copy()
+    mac.update(sig_basestring.encode("utf-8"))
+    expected_signature = 'v0=' + mac.hexdigest()
 
     # Check if the signature matches
     return hmac.compare_digest(expected_signature, slack_signature)
@@ -70,11 +75,11 @@ def slack_signature_required(f):
         # Verifying the request timestamp to protect against replay attacks
         if abs(time.time() - int(timestamp)) > 60 * 5:
             logging.info("Request timestamp is too far from local time!")
-            return jsonify({"status": "error", "message": "Invalid timestamp"}), 403
+            return json_response(INVALID_TIMESTAMP_BODY, 403)
 
         if not validate_slack_signature(request.get_data(as_text=True), slack_signature, timestamp):
             logging.info("Signature verification failed!")
-            return jsonify({"status": "error", "message": "Invalid signature"}), 403
+            return json_response(INVALID_SIGNATURE_BODY, 403)
 
         return f(*args, **kwargs)
 
@@ -1,21 +1,47 @@
 import logging
-import json
+from concurrent.futures import ThreadPoolExecutor
 
-from flask import Blueprint, request, jsonify, current_app
+from flask import Blueprint, request, current_app
 
 from datetime import datetime
 
 from .decorators.security import whatsapp_signature_required, twilio_signature_required
 from .utils.whatsapp_utils import (
     process_whatsapp_message,
-    is_valid_whatsapp_message
+    is_valid_whatsapp_message,
+    get_whatsapp_statuses,
 )
 from flask import request, Response
+from werkzeug.exceptions import HTTPException
+from .utils.json_responses import (
+    json_response,
+    ok_response,
+    INVALID_JSON_BODY,
+    NOT_WHATSAPP_EVENT_BODY,
+    INTERNAL_ERROR_BODY,
+    VERIFICATION_FAILED_BODY,
+    MISSING_PARAMETERS_BODY,
+)
 
 
 webhook_blueprint = Blueprint("webhook", __name__)
 
 
+# Bounded pool for the RAG pipeline: a burst of messages queues here instead of starting
+# one thread per message
+MESSAGE_WORKERS = 8
+message_executor = ThreadPoolExecutor(max_workers=MESSAGE_WORKERS, thread_name_prefix="whatsapp-message")
+
+
+def process_in_background(app, body, req_time):
+    """
+    Run the RAG pipeline for a message outside the request thread so the webhook can be ACKed
+    immediately; WhatsApp retries deliveries that are not answered quickly.
+    """
+    with app.app_context():
+        process_whatsapp_message(body, req_time)
+
+
 def handle_message(req_time):
     """
     Handle incoming webhook events from the WhatsApp API.
@@ -30,32 +56,37 @@ def handle_message(req_time):
     Returns:
         response: A tuple containing a JSON response and an HTTP status code.
     """
-    body = request.get_json()
+    # Parsed once and cached on the request; None for a missing/malformed JSON body
+    body = request.get_json(cache=True, silent=True)
+    if body is None:
+        logging.error("Failed to decode JSON")
+        return json_response(INVALID_JSON_BODY, 400)
     # logging.info(f"request body: {body}")
 
     # Check if it's a WhatsApp status update
-    if (
-        body.get("entry", [{}])[0]
-        .get("changes", [{}])[0]
-        .get("value", {})
-        .get("statuses")
-    ):
+    statuses = get_whatsapp_statuses(body)
+    if statuses:
         logging.info("Received a WhatsApp status update.")
-        return jsonify({"status": "ok"}), 200
+        return ok_response()
 
-    try:
-        if is_valid_whatsapp_message(body):
-            process_whatsapp_message(body, req_time)
-            return jsonify({"status": "ok"}), 200
-        else:
-            # if the request is not a WhatsApp API event, return an error
-            return (
-                jsonify({"status": "error", "message": "Not a WhatsApp API or Slack API event"}),
-                404,
-            )
-    except json.JSONDecodeError:
-        logging.error("Failed to decode JSON")
-        return jsonify({"status": "error", "message": "Invalid JSON provided"}), 400
+    if is_valid_whatsapp_message(body):
+        message_executor.submit(process_in_background, current_app._get_current_object(), body, req_time)
+        return ok_response()
+    else:
+        # if the request is not a WhatsApp API event, return an error
+        return json_response(NOT_WHATSAPP_EVENT_BODY, 404)
+
+
+@webhook_blueprint.errorhandler(Exception)
+def handle_unexpected_error(error):
+    """
+    Single JSON 500 for anything the webhook handlers did not anticipate, instead of
+    per-handler try/except blocks. HTTP errors (404, 405, ...) keep their own response.
+    """
+    if isinstance(error, HTTPException):
+        return error
+    logging.exception("Unhandled error in webhook handler")
+    return json_response(INTERNAL_ERROR_BODY, 500)
 
 
 # Required webhook verifictaion for WhatsApp
@@ -77,11 +108,11 @@ def verify():
             # Responds with '403 Forbidden' if verify tokens do not match
             logging.info("VERIFICATION_FAILED")
             print(f"Mode: {mode}, Token: {token}, Verify token: {current_app.config['VERIFY_TOKEN']}, Challenge: {challenge}")
-            return jsonify({"status": "error", "message": "Verification failed"}), 403
+            return json_response(VERIFICATION_FAILED_BODY, 403)
     else:
         # Responds with '400 Bad Request' if verify tokens do not match
         logging.info("MISSING_PARAMETER")
-        return jsonify({"status": "error", "message": "Missing parameters"}), 400
+        return json_response(MISSING_PARAMETERS_BODY, 400)
 
 
 @webhook_blueprint.route("/")
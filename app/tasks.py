@@ -1,9 +1,13 @@
 # app/tasks.py
 
 from celery import Celery, shared_task
-from flask import Flask
+from celery.signals import worker_process_init, worker_process_shutdown
+from flask import Flask, has_app_context
 # glo
 
+# App context pushed once per prefork worker child (see make_celery)
+worker_app_context = None
+
 
 
 def make_celery(app):
@@ -13,9 +17,32 @@ def make_celery(app):
         broker=app.config['CELERY_BROKER_URL']
     )
     celery.conf.update(app.config)
+    celery.conf.update(
+        # msgpack payloads are smaller and faster to (de)serialize than JSON on the broker path
+        task_serializer="msgpack",
+        result_serializer="msgpack",
+        accept_content=["msgpack", "json"],
+    )
+
+    @worker_process_init.connect(weak=False)
+    def push_worker_app_context(**kwargs):
+        global worker_app_context
+        worker_app_context = app.app_context()
+        worker_app_context.push()
+
+    @worker_process_shutdown.connect(weak=False)
+    def pop_worker_app_context(**kwargs):
+        global worker_app_context
+        if worker_app_context is not None:
+            worker_app_context.pop()
+            worker_app_context = None
 
     class ContextTask(celery.Task):
         def __call__(self, *args, **kwargs):
+            # Prefork children already run inside the context pushed at process init;
+            # only solo/thread pools and eager calls still need a per-task one
+            if has_app_context():
+                return self.run(*args, **kwargs)
             with app.app_context():
                 return self.run(*args, **kwargs)
 
@@ -0,0 +1,26 @@
+import json
+from flask import Response
+
+
+# The webhook's JSON replies never change (the ACK alone is sent 4 times per message),
+# so they are serialized once at import and shared by every blueprint and decorator
+def error_body(message):
+    return json.dumps({"status": "error", "message": message}).encode("utf-8")
+
+
+OK_RESPONSE_BODY = json.dumps({"status": "ok"}).encode("utf-8")
+INVALID_JSON_BODY = error_body("Invalid JSON provided")
+NOT_WHATSAPP_EVENT_BODY = error_body("Not a WhatsApp API or Slack API event")
+INTERNAL_ERROR_BODY = error_body("Internal server error")
+VERIFICATION_FAILED_BODY = error_body("Verification failed")
+MISSING_PARAMETERS_BODY = error_body("Missing parameters")
+INVALID_SIGNATURE_BODY = error_body("Invalid signature")
+INVALID_TIMESTAMP_BODY = error_body("Invalid timestamp")
+
+
+def json_response(body, status):
+    return Response(body, status=status, mimetype="application/json")
+
+
+def ok_response():
+    return json_response(OK_RESPONSE_BODY, 200)
@@ -0,0 +1,125 @@
+import logging
+import time
+import unicodedata
+from collections import Counter
+import numpy as np
+import orjson
+
+
+class LLMCache:
+    """
+    RAG answers kept in SQLite next to the response logs (same connection, with `lock`
+    serialising every use of it).
+    A repeat of an earlier question (case, spacing and trailing punctuation aside) is matched
+    on its normalised text. Otherwise, when the caller passes the query's embedding (see
+    `embedding`), it is matched by cosine similarity against cached queries written in the same
+    script, and the closest one at or above `threshold` is reused. The encoder is multilingual,
+    so without the script check a Hindi question would be served the English answer to its
+    translation, while the RAG server answers in the language of the query.
+    Answers carry the RAG server's "provided as of <date>" note, so only entries written today
+    (local time, the clock the server dates its note by) are used, and never ones older than
+    `ttl` seconds.
+    """
+
+    def __init__(self, conn, lock, ttl=24 * 3600, embed=None, threshold=0.92):
+        self.conn = conn
+        self.lock = lock
+        self.ttl = ttl
+        self.embed = embed
+        self.threshold = threshold
+        self.hits = 0
+        self.misses = 0
+        with self.lock:
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS RAG_response_cache (
+                QueryKey TEXT PRIMARY KEY,
+                Query TEXT,
+                Response TEXT,
+                Responses BLOB,
+                CreatedAt REAL,
+                Embedding BLOB,
+                Script TEXT
+            )""")
+            # Tables created before the embedding match lack its columns
+            columns = {row[1] for row in self.conn.execute("PRAGMA table_info(RAG_response_cache)")}
+            for column, column_type in (("Embedding", "BLOB"), ("Script", "TEXT")):
+                if column not in columns:
+                    self.conn.execute(f"ALTER TABLE RAG_response_cache ADD COLUMN {column} {column_type}")
+            self.conn.commit()
+
+    @staticmethod
+    def key(query):
+        return " ".join(query.casefold().split()).rstrip("?.!")
+
+    @staticmethod
+    def script(query):
+        """Dominant Unicode script of the query's letters (LATIN, DEVANAGARI, ...), or "" for none."""
+        scripts = Counter(unicodedata.name(ch, "").split(" ", 1)[0] for ch in query if ch.isalpha())
+        return scripts.most_common(1)[0][0] if scripts else ""
+
+    def embedding(self, query):
+        """The query's embedding for get and set, or None when there is no encoder."""
+        return self.embed(query) if self.embed is not None else None
+
+    @staticmethod
+    def fresh_since(ttl):
+        """Earliest CreatedAt still usable: today's local midnight, or `ttl` seconds ago if later."""
+        now = time.time()
+        midnight = time.mktime(time.localtime(now)[:3] + (0, 0, 0, 0, 0, -1))
+        return max(midnight, now - ttl)
+
+    def get(self, query, embedding=None):
+        """Return (response, responses) for a cached query or a close paraphrase of one, or None."""
+        since = self.fresh_since(self.ttl)
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT Response, Responses FROM RAG_response_cache WHERE QueryKey = ? AND CreatedAt >= ?",
+                (self.key(query), since),
+            ).fetchone()
+        if row is None and embedding is not None:
+            row = self._nearest(query, embedding, since)
+        with self.lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        logging.debug("Response cache hit (%s)", self.stats)
+        return row[0], orjson.loads(row[1])
+
+    def _nearest(self, query, embedding, since):
+        # Only the vectors are read for the comparison; the answer is fetched for the winner alone
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT rowid, Embedding FROM RAG_response_cache "
+                "WHERE CreatedAt >= ? AND Script = ? AND Embedding IS NOT NULL",
+                (since, self.script(query)),
+            ).fetchall()
+        if not rows:
+            return None
+        # One matmul over the day's cached queries; the embeddings are normalised, so this is cosine similarity
+        matrix = np.stack([np.frombuffer(row[1], dtype=np.float32) for row in rows])
+        similarities = matrix @ np.asarray(embedding, dtype=np.float32)
+        best = int(similarities.argmax())
+        if similarities[best] < self.threshold:
+            return None
+        with self.lock:
+            # None if the row was replaced in between, which counts as a miss
+            return self.conn.execute(
+                "SELECT Response, Responses FROM RAG_response_cache WHERE rowid = ?", (rows[best][0],)
+            ).fetchone()
+
+    def set(self, query, response, responses, embedding=None):
+        if embedding is not None:
+            embedding = np.asarray(embedding, dtype=np.float32).tobytes()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO RAG_response_cache "
+                "(QueryKey, Query, Response, Responses, CreatedAt, Embedding, Script) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (self.key(query), query, response, orjson.dumps(responses), time.time(), embedding,
+                 self.script(query)),
+            )
+            self.conn.commit()
+
+    @property
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
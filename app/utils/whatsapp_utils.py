@@ -1,7 +1,9 @@
 import logging
 from flask import current_app, jsonify
-import json
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import random
 import re
 # from openai import OpenAI, AsyncOpenAI
@@ -9,29 +11,219 @@ from anthropic import Anthropic
 import threading
 import time
 import datetime
+import hashlib
 import sqlite3
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from functools import lru_cache, partial
+from app.utils.llm_cache import LLMCache
 
 
-whatsapp_recepient_question_set = {}
-slack_recepient_question_set = {}
+# Shared across calls so the Graph API and RAG server connections are kept alive
+# instead of paying DNS + TCP (+ TLS) setup on every message
+http_session = requests.Session()
+# Enough pooled keep-alive connections for concurrent workers; one quick retry covers a dropped
+# connection (POSTs are not retried on error statuses, so a message is never sent twice)
+http_adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32,
+                           max_retries=Retry(total=1, backoff_factor=0.1, status_forcelist=[502, 503, 504]))
+http_session.mount("http://", http_adapter)
+http_session.mount("https://", http_adapter)
+
+# First entry of every conversation, prepended when a history is sent out; one shared,
+# never-mutated dict so every history starts with byte-identical text
+SYSTEM_MESSAGE = {"role": "system",
+                  "content": "You are an helpful assistant that answers all general queries related to"
+                             " Meghalaya Public Services Delivery Commision using your knowledge base. "
+                             "Do not answer queries that are not related to Meghalaya Public Services Delivery Commision."}
+
+# Longest message_history sent per user, system message included; older turns are dropped first
+MAX_HISTORY_LENGTH = 20
+# Approximate token budget for a user's turns, so a few long answers cannot blow up every prompt
+HISTORY_TOKEN_BUDGET = 6000
+
+
+def new_history():
+    # Ring buffer of the user's turns: appends are O(1) and the oldest turn falls off by itself
+    return deque(maxlen=MAX_HISTORY_LENGTH - 1)
+
+
+def entry_tokens(entry):
+    # ~4 characters per token; close enough for a budget without running a tokenizer per turn
+    return len(entry["content"]) // 4 + 1
+
+
+class UserSessions:
+    """
+    Conversation state per user id, evicting the least recently active user once more than
+    `maxsize` are held. Each session carries its own lock; take it around every read or write of
+    that user's history, since handler threads for the same user can run concurrently.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, user_id):
+        with self.lock:
+            session = self.sessions.get(user_id)
+            if session is None:
+                session = self.sessions[user_id] = {"message_history": new_history(), "history_tokens": 0,
+                                                    "previous_messages": [], "lock": threading.Lock()}
+                if len(self.sessions) > self.maxsize:
+                    self.sessions.popitem(last=False)
+            else:
+                self.sessions.move_to_end(user_id)
+            return session
+
+
+whatsapp_recepient_question_set = UserSessions()
+slack_recepient_question_set = UserSessions()
 
 general_response = "I am a helpful AI based Chatbot for Meghalaya State Public Services Delivery Commission (MSPSDC)"
-preprocess_responses = ["Got it! Let me find information about it...", "Processing...", "Working on it...",
+preprocess_responses = ("Got it! Let me find information about it...", "Processing...", "Working on it...",
                         "Fetching...", "Getting your results for you...",
                         "Let me check that out for you...", "Searching...",
-                        "Alright! Let me look into that query for you..."]
+                        "Alright! Let me look into that query for you...")
+no_text_response = ("I am here to help you with any form of text queries related to Meghalaya State Public Services Delivery Commission (MSPSDC), "
+                    "please ask me anything in that context and I'd be happy to assist you!")
+# Business number whose inbound messages are answered
+allowed_display_number = '919811294652'
+# Intermediate messages sent while a RAG answer is pending: how many, and seconds apart
+HEARTBEAT_COUNT = 3
+HEARTBEAT_INTERVAL = 60
+# Sent while a slow RAG query is still running; built once instead of on every wait tick
+intermediate_messages = ("Hold on, I'm fetching the results for you.",
+                         "Please wait a moment, I'm retrieving the information.",
+                         "Fetching data, just a moment please.",
+                         "Almost done!",
+                         "Please hold on while I fetch your results.",
+                         "Almost done fetching, don't go away!",
+                         "Fetching data, appreciate your patience!",
+                         "Getting your data, thank you for waiting!")
+
+
+
+
+@lru_cache(maxsize=None)
+def get_anthropic_client():
+    """
+    One Anthropic client per process so its HTTP connection pool (and TLS session) is
+    reused across calls instead of being rebuilt for every classification/translation.
+    """
+    return Anthropic()
 
 
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive failures. While open, calls are skipped for
+    `recovery` seconds, doubling (up to `max_backoff` times) on every failed trial call.
+    After that a single trial call is let through (half-open); its success closes it again.
+    """
+
+    def __init__(self, threshold=3, recovery=30, max_backoff=8):
+        self.threshold = threshold
+        self.recovery = recovery
+        self.max_backoff = max_backoff
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.failures < self.threshold:
+                return True
+            if self.trial_in_flight:
+                return False
+            backoff = min(2 ** (self.failures - self.threshold), self.max_backoff)
+            if time.monotonic() - self.opened_at < self.recovery * backoff:
+                return False
+            self.trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+
+# Outbound request constants, shared by every call instead of rebuilt per message
+# (requests copies headers into its own mapping, so the dicts are never mutated)
+RAG_QUERY_URL = 'http://127.0.0.1:5000/query/'
+JSON_HEADERS = {'Content-Type': 'application/json'}
+SLACK_POST_MESSAGE_URL = "https://slack.com/api/chat.postMessage"
+SLACK_HEADERS = {
+    'Authorization': '',
+    'Content-Type': 'application/json'
+}
+
+
+@lru_cache(maxsize=None)
+def graph_api_request(version, phone_number_id, access_token):
+    """
+    Messages endpoint URL and headers for a WhatsApp Cloud API configuration, built once per config.
+    """
+    url = f"https://graph.facebook.com/{version}/{phone_number_id}/messages"
+    headers = {
+        "Content-type": "application/json",
+        "Authorization": f"Bearer {access_token}",
+    }
+    return url, headers
+
+
+# Skips the RAG server while it is down instead of waiting out a timeout on every message
+rag_breaker = CircuitBreaker()
+
+# In-flight RAG server requests keyed by request body, see post_rag_query
+inflight_rag_queries = {}
+inflight_rag_lock = threading.Lock()
+
+
+def post_rag_query(url, query_json, headers, timeout):
+    """
+    Singleflight POST to the RAG server: concurrent calls with an identical body (same query and
+    history) wait on the first caller's request instead of each sending their own.
+    """
+    key = hashlib.blake2b(query_json, digest_size=16).digest()
+    with inflight_rag_lock:
+        future = inflight_rag_queries.get(key)
+        leader = future is None
+        if leader:
+            future = inflight_rag_queries[key] = Future()
+    if not leader:
+        return future.result()
+
+    try:
+        response = http_session.post(url, data=query_json, headers=headers, timeout=timeout)
+        future.set_result(response)
+        return response
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with inflight_rag_lock:
+            del inflight_rag_queries[key]
 
 
 def log_http_response(response):
-    logging.info(f"Status: {response.status_code}")
-    logging.info(f"Content-type: {response.headers.get('content-type')}")
-    logging.info(f"Body: {response.text}")
+    # response.text decodes the whole body, so skip it entirely when INFO is off
+    if not logging.getLogger().isEnabledFor(logging.INFO):
+        return
+    logging.info("Status: %s", response.status_code)
+    logging.info("Content-type: %s", response.headers.get('content-type'))
+    logging.info("Body: %s", response.text)
 
 
 def get_text_message_input(recipient, text):
-    return json.dumps(
+    return orjson.dumps(
         {
             "messaging_product": "whatsapp",
             "recipient_type": "individual",
@@ -44,110 +236,127 @@ def get_text_message_input(recipient, text):
 
 def generate_response(user_id, query, query_type, message_history, msg_system, channel_id=None):
     print(f"INPUT FOR app.py and openai: {query}")
+    # Repeated questions are answered from the cache without calling the RAG server
+    response_cache = get_response_cache(current_app.config["GENERAL_QUESTION_MODEL"])
+    query_embedding = None
+    if response_cache is not None and query_type != "greeting":
+        # Encoded once here and reused by set on a miss
+        query_embedding = response_cache.embedding(query)
+        cached = response_cache.get(query, query_embedding)
+        if cached is not None:
+            response, responses = cached
+            return response, responses, datetime.datetime.now().time().isoformat(timespec='milliseconds')
+
     send_msg = "I apologize! There seems to be a backend issue. Can you please ask another query?"
     # send_msg = "I'm undergoing some maintainence! I'll be back online on Saturday. In case you any emergency, you can contact iHub Anubhuti team or call at +91 9306024352"
 
-    url = 'http://127.0.0.1:5000/query/'
-    headers = {'Content-Type': 'application/json'}
-    json_message = {"query": query, "message_history": message_history, "query_type":query_type}
-    query_json = json.dumps(json_message)
+    url = RAG_QUERY_URL
+    headers = JSON_HEADERS
+    json_message = {"query": query, "message_history": [SYSTEM_MESSAGE, *message_history], "query_type":query_type}
+    query_json = orjson.dumps(json_message)
 
-    response = None
+    def send_fallback():
+        # WhatsApp callers send the returned text themselves, so only Slack is sent from here;
+        # the empty list leaves nothing to add to the user's history
+        if msg_system != "wp":
+            send_response_to_slack(channel_id, send_msg, user_id)
+        resp_time = datetime.datetime.now().time().isoformat(timespec='milliseconds')
+        return send_msg, [], resp_time
 
-    class TimeoutException(Exception):
-        pass
+    if not rag_breaker.allow():
+        logging.warning("RAG server circuit is open, replying with the fallback message")
+        return send_fallback()
 
-    def fetch_response():
-        nonlocal response
-        try:
-            response = requests.post(url, data=query_json, headers=headers, timeout=600)
-        except requests.Timeout:
-            raise TimeoutException("API request timed out")
- 
-    # Start the API request in a separate thread
-    api_thread = threading.Thread(target=fetch_response)
-    api_thread.start()
-
-    wait_time = 60
-    trials = 3
-    while api_thread.is_alive():
-        if query_type == "greeting":
-            continue
-        elif wait_time % 60 == 0 and trials != 0:
-            trials -= 1
-            # Send an intermediate message to the user
-            intermediate_messages = [
-                "Hold on, I'm fetching the results for you.",
-                "Please wait a moment, I'm retrieving the information.",
-                "Fetching data, just a moment please.",
-                "Almost done!",
-                "Please hold on while I fetch your results.",
-                "Almost done fetching, don't go away!",
-                "Fetching data, appreciate your patience!",
-                "Getting your data, thank you for waiting!"
-            ]
-            intermediate_message = random.choice(intermediate_messages)
-            translated_msg = intermediate_message
-            # translated_msg = translate(query, intermediate_message)
-
-            translated_msg_parts = translated_msg.split("\n")
-            msg_to_be_sent = translated_msg_parts[-1].split(":")[-1].strip()
-
-            if msg_system == "wp":
-                send_response = get_text_message_input(user_id, msg_to_be_sent)
-                send_message(send_response)
-            else:
-                send_response_to_slack(channel_id, msg_to_be_sent, user_id)
+    # (connect, read): an unreachable RAG server fails in seconds, generation may still take minutes
+    rag_settings = current_app.config["RAG"]
+    timeout = rag_settings.timeout
+    max_retries = rag_settings.max_retries
 
-        time.sleep(1)
-        wait_time -= 1
+    def fetch_response():
+        for attempt in range(max_retries + 1):
+            try:
+                return post_rag_query(url, query_json, headers, timeout=timeout)
+            except requests.Timeout:
+                if attempt == max_retries:
+                    raise
+                # exponential backoff before re-dispatching a stuck generation
+                time.sleep(2 ** attempt)
+
+    def send_heartbeat():
+        # Send an intermediate message to the user
+        intermediate_message = intermediate_messages[random.randrange(len(intermediate_messages))]
+        translated_msg = intermediate_message
+        # translated_msg = translate(query, intermediate_message)
+
+        translated_msg_parts = translated_msg.split("\n")
+        msg_to_be_sent = translated_msg_parts[-1].split(":")[-1].strip()
 
-    # If API thread is still running, it means it hasn't completed within 2 minutes
-    if api_thread.is_alive():
-        # Terminate the thread
-        api_thread.join()
         if msg_system == "wp":
-            send_response = get_text_message_input(
-                user_id,
-                send_msg
-            )
+            send_response = get_text_message_input(user_id, msg_to_be_sent)
             send_message(send_response)
         else:
-            send_response_to_slack(channel_id, send_msg, user_id)
-        resp_time = datetime.datetime.now().time().isoformat(timespec='milliseconds')
-        return send_msg, None, resp_time
+            send_response_to_slack(channel_id, msg_to_be_sent, user_id)
+
+    def send_heartbeat_in_context(app):
+        # Runs on a timer thread, so it needs its own app context for send_message
+        with app.app_context():
+            send_heartbeat()
+
+    # Intermediate messages at 0s, 60s and 120s while the RAG server works, sent from timers while
+    # the request blocks this thread instead of a second thread polling it every second. The first
+    # is on a timer too, so the RAG request does not wait for its Graph API POST
+    heartbeats = []
+    response = None
+    try:
+        if query_type != "greeting":
+            app = current_app._get_current_object()
+            heartbeats = [threading.Timer(HEARTBEAT_INTERVAL * i, send_heartbeat_in_context, args=(app,))
+                          for i in range(HEARTBEAT_COUNT)]
+            for timer in heartbeats:
+                timer.daemon = True
+                timer.start()
+        try:
+            response = fetch_response()
+        except requests.RequestException as e:
+            logging.warning("RAG server request failed: %s", e)
+        finally:
+            # cancel() only stops timers that have not fired yet; join waits out a heartbeat that is
+            # already being sent, so it can never arrive after the answer
+            for timer in heartbeats:
+                timer.cancel()
+            for timer in heartbeats:
+                timer.join()
+    finally:
+        # Recorded on every way out, exceptions included: a half-open trial that is never recorded
+        # leaves trial_in_flight set and the circuit open until the process restarts.
+        # Connection errors/timeouts leave response unset; 5xx means the server itself is failing
+        if response is None or response.status_code >= 500:
+            rag_breaker.record_failure()
+        else:
+            rag_breaker.record_success()
 
     # API request completed within the timeout
-    if response.status_code == 200:
-        # Print the response content
-        print("RESPONSE FROM THE SERVER AT 5000 PORT:", response.json())
-        return response.json()["response"], response.json()["responses"], response.json()["response_time"]
+    if response is not None and response.status_code == 200:
+        # Parse the body once instead of calling response.json() for every field
+        result = orjson.loads(response.content)
+        print("RESPONSE FROM THE SERVER AT 5000 PORT:", result)
+        if response_cache is not None and query_type != "greeting":
+            response_cache.set(query, result["response"], result["responses"], query_embedding)
+        return result["response"], result["responses"], result["response_time"]
     else:
-        print("FAILED TO GET A RESPONSE FROM THE SERVER AT 5000 PORT, status code:", response.status_code)
-        if msg_system == "wp":
-            send_response = get_text_message_input(
-                user_id,
-                send_msg
-            )
-            send_message(send_response)
-        else:
-            send_response_to_slack(channel_id, send_msg, user_id)
-        resp_time = datetime.datetime.now().time().isoformat(timespec='milliseconds')
-        return send_msg, None, resp_time
+        print("FAILED TO GET A RESPONSE FROM THE SERVER AT 5000 PORT, status code:",
+              response.status_code if response is not None else None)
+        return send_fallback()
 
 
 def send_message(data):
-    headers = {
-        "Content-type": "application/json",
-        "Authorization": f"Bearer {current_app.config['ACCESS_TOKEN']}",
-    }
+    url, headers = graph_api_request(current_app.config['VERSION'], current_app.config['PHONE_NUMBER_ID'],
+                                     current_app.config['ACCESS_TOKEN'])
 
     print(data)
 
-    url = f"https://graph.facebook.com/{current_app.config['VERSION']}/{current_app.config['PHONE_NUMBER_ID']}/messages"
-
     try:
-        response = requests.post(url, data=data, headers=headers, timeout=10)  # 10 seconds timeout as an example
+        response = http_session.post(url, data=data, headers=headers, timeout=(3, 10))  # (connect, read) timeouts
         response.raise_for_status()  # Raises an HTTPError if the HTTP request returned an unsuccessful status code.
     except requests.Timeout:
         logging.error("Timeout occurred while sending message")
@@ -155,12 +364,12 @@ def send_message(data):
     except requests.HTTPError as http_err:
         # Extract error details from the response
         error_details = response.json()  # Assuming the error details are in JSON format
-        logging.error(f"HTTP error occurred: {http_err} - Details: {error_details}")
+        logging.error("HTTP error occurred: %s - Details: %s", http_err, error_details)
         # Return or log the detailed error message for further investigation
         return jsonify({"status": "error", "message": "HTTP error", "details": error_details}), 500
     except requests.RequestException as req_err:
         # This will catch any general request exception
-        logging.error(f"Request failed due to: {req_err}")
+        logging.error("Request failed due to: %s", req_err)
         return jsonify({"status": "error", "message": "Failed to send message"}), 500
     else:
         # Process the response as normal
@@ -168,26 +377,93 @@ def send_message(data):
         return response
 
 
+# Compiled once; process_text_for_whatsapp runs on every outbound reply
+# Citation brackets like 【4:0†source】
+BRACKET_PATTERN = re.compile(r"\【.*?\】")
+# Double asterisks including the word(s) in between
+BOLD_PATTERN = re.compile(r"\*\*(.*?)\*\*")
+
+
 def process_text_for_whatsapp(text):
     # Remove brackets
-    pattern = r"\【.*?\】"
-    # Substitute the pattern with an empty string
-    text = re.sub(pattern, "", text).strip()
+    text = BRACKET_PATTERN.sub("", text).strip()
 
-    # Pattern to find double asterisks including the word(s) in between
-    pattern = r"\*\*(.*?)\*\*"
+    # Replace double asterisks with WhatsApp's single-asterisk bold
+    whatsapp_style_text = BOLD_PATTERN.sub(r"*\1*", text)
 
-    # Replacement pattern with single asterisks
-    replacement = r"*\1*"
+    return whatsapp_style_text
 
-    # Substitute occurrences of the pattern with the replacement
-    whatsapp_style_text = re.sub(pattern, replacement, text)
 
-    return whatsapp_style_text
+CLAUDE_MODEL = "claude-3-haiku-20240307"
+
+
+def claude_complete(content, system=None, max_tokens=4096, temperature=0.6, stop_sequences=None):
+    """
+    Single-turn Claude call shared by the classifier/translation helpers below; returns the reply text.
+    """
+    kwargs = {"system": system} if system is not None else {}
+    if stop_sequences is not None:
+        kwargs["stop_sequences"] = stop_sequences
+    response = get_anthropic_client().messages.create(
+        model=CLAUDE_MODEL,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        messages=[
+            {"role": "user", "content": content}
+        ],
+        **kwargs,
+    )
+    return response.content[0].text
+
+
+# One-word classifier answers: a few tokens of decode budget, cut at the first full stop
+CLASSIFIER_MAX_TOKENS = 4
+CLASSIFIER_STOP_SEQUENCES = ["."]
+
+# Small-talk questions answered with general_response instead of a RAG lookup
+GENERAL_QUESTIONS = ("What's up", "What's your role", "What can you do", "What is your role", "Who are you",
+                     "What’s your purpose", "What is your purpose", "What are you doing", "What're you doing")
+# Cosine similarity to one of GENERAL_QUESTIONS at which a message counts as a general question
+GENERAL_QUESTION_THRESHOLD = 0.75
+
+
+@lru_cache(maxsize=None)
+def get_general_question_encoder(model_name):
+    """
+    Multilingual sentence encoder plus the normalised embeddings of GENERAL_QUESTIONS, loaded
+    once per process. None when sentence-transformers is not installed or the model cannot be
+    downloaded or loaded, in which case is_general_question falls back to asking Claude and the
+    response cache matches exact repeats only. The None is cached too, so a failed load is
+    logged and retried once per process rather than on every message.
+    """
+    try:
+        from sentence_transformers import SentenceTransformer
+    except ImportError:
+        logging.warning("sentence-transformers is not installed, classifying general questions with Claude")
+        return None
+    try:
+        model = SentenceTransformer(model_name, device="cpu")
+        question_embeddings = model.encode(list(GENERAL_QUESTIONS), normalize_embeddings=True,
+                                           convert_to_numpy=True)
+    except Exception:
+        # Typically a failed download (OSError/HTTP error) or a bad model name
+        logging.exception("Could not load %s, classifying general questions with Claude", model_name)
+        return None
+    return model, question_embeddings
 
 
 def is_general_question(message):
-    content = f"""You need to check if the query contains any of the general questions from the list given or even 
+    model_name = current_app.config["GENERAL_QUESTION_MODEL"]
+    encoder = get_general_question_encoder(model_name) if model_name else None
+    if encoder is not None:
+        # Local check against the canned questions: one small encoder pass instead of an API round trip
+        model, question_embeddings = encoder
+        message_embedding = model.encode(message, normalize_embeddings=True, convert_to_numpy=True)
+        similarity = float((question_embeddings @ message_embedding).max())
+        reply = "True" if similarity >= GENERAL_QUESTION_THRESHOLD else "False"
+    else:
+        # Continuation lines keep their original indentation so the prompt text is unchanged
+        content = f"""You need to check if the query contains any of the general questions from the list given or even 
     similar questions. The query can be in any language, you need to check if the query is in the same context. You need
     to respond with  True or False accordingly.
     general_questions = ["What's up", "What's your role", "What can you do", "What is your role", "Who are you",
@@ -196,18 +472,14 @@ def is_general_question(message):
     Text: {message}
     Class: """
 
-    client = Anthropic()
-    response = client.messages.create(
-        model="claude-3-haiku-20240307",
-        temperature=0.6,
-        system = "You are a computer system which only gives boolean response i.e. True or False for checking if the query is a general question.",
-        max_tokens=4096,
-        messages=[
-            {"role": "user", "content": content}
-        ]
-    )
-    print(f"IS GENERAL QUESTION: {response.content[0].text}")
-    return response.content[0].text
+        reply = claude_complete(
+            content,
+            system="You are a computer system which only gives boolean response i.e. True or False for checking if the query is a general question.",
+            max_tokens=CLASSIFIER_MAX_TOKENS,
+            stop_sequences=CLASSIFIER_STOP_SEQUENCES,
+        )
+    print(f"IS GENERAL QUESTION: {reply}")
+    return reply
 
 
 def check_message_type(message):
@@ -218,21 +490,17 @@ def check_message_type(message):
     Text: {message}
     Class: """
 
-    client = Anthropic()
-    response = client.messages.create(
-        model="claude-3-haiku-20240307",
-        temperature=0.6,
-        system = "You are a computer system which only gives binary response. answer one word: either 'greeting' or 'query'",
-        max_tokens=4096,
-        messages=[
-            {"role": "user", "content": content}
-        ]
+    reply = claude_complete(
+        content,
+        system="You are a computer system which only gives binary response. answer one word: either 'greeting' or 'query'",
+        max_tokens=CLASSIFIER_MAX_TOKENS,
+        stop_sequences=CLASSIFIER_STOP_SEQUENCES,
     )
     print("/-"*10)
-    print(f"MESSAGE TYPE: {response.content[0].text}")
+    print(f"MESSAGE TYPE: {reply}")
     print("/-"*10)
 
-    return response.content[0].text
+    return reply
 
 
 def translate(query, eng_message):
@@ -246,21 +514,13 @@ def translate(query, eng_message):
     English Message: {eng_message}
     Message in detected language: """
 
-    client = Anthropic()
-    response = client.messages.create(
-        model="claude-3-haiku-20240307",
-        temperature=0.6,
-        max_tokens=4096,
-        messages=[
-            {"role": "user", "content": content}
-        ]
-    )
+    reply = claude_complete(content)
     print("-"*50)
     print(f"Query = {query} English Message: {eng_message}")
-    print(f"TRANSLATION: {response.content[0].text}")
+    print(f"TRANSLATION: {reply}")
     print("-"*50)
 
-    return response.content[0].text
+    return reply
 
 #TODO fix later
 def refine_query(query, message_history):
@@ -277,22 +537,16 @@ def refine_query(query, message_history):
     Message History: {message_history}
     Refined Question: """
 
-    client = Anthropic()
-    response = client.messages.create(
-        model="claude-3-haiku-20240307",
-        temperature=0.6,
+    reply = claude_complete(
+        content,
         system="You are an English professor. You need to parse the user question and return the question in proper English.",
-        max_tokens=4096,
-        messages=[
-            {"role": "user", "content": content}
-        ]
     )
     print("*"*50)
     # print(content)
-    print(f"Refined query: {response.content[0].text}")
+    print(f"Refined query: {reply}")
     print("*"*50)
 
-    return response.content[0].text
+    return reply
 
 
 def unix_to_datetime(unix_timestamp):
@@ -301,17 +555,9 @@ def unix_to_datetime(unix_timestamp):
 
 
 def is_within_tolerance(unix_timestamp, tolerance_seconds=3):
-    # Get current datetime in UTC
-    current_utc_time = datetime.datetime.utcnow()
-
-    # Convert Unix timestamp to datetime object
-    target_datetime = unix_to_datetime(unix_timestamp)
-
-    # Calculate the difference in seconds
-    time_diff_seconds = (current_utc_time - target_datetime).total_seconds()
-
-    # Check if the difference is within the tolerance
-    return abs(time_diff_seconds) <= tolerance_seconds
+    # Both sides are seconds since the epoch, so compare them directly
+    # instead of building and subtracting two datetime objects
+    return abs(time.time() - float(unix_timestamp)) <= tolerance_seconds
 
 
 def create_table(conn, create_table_sql):
@@ -326,7 +572,8 @@ def create_table(conn, create_table_sql):
 def create_connection(db_file):
     """Create a database connection to a SQLite database."""
     try:
-        conn = sqlite3.connect(db_file)
+        # Shared by the handler threads of a process; writes are serialised with log_db_lock
+        conn = sqlite3.connect(db_file, check_same_thread=False)
         print(sqlite3.version)
         return conn
     except Exception as e:
@@ -335,26 +582,78 @@ def create_connection(db_file):
 
 database = 'rag_response_logging.db'
 
+sql_create_rag_responses_table = """CREATE TABLE IF NOT EXISTS RAG_timed_logs (
+Id INTEGER PRIMARY KEY AUTOINCREMENT,
+PhoneNumber TEXT,
+UserQuery TEXT,
+BotResponse TEXT,
+CreatedDate TEXT,
+CreatedTime TEXT,
+"Latency(s)" INTEGER
+); """
 
+log_db_lock = threading.Lock()
 
-def process_whatsapp_message(body, req_time):
-
-    sql_create_rag_responses_table = """CREATE TABLE IF NOT EXISTS RAG_timed_logs (
-    Id INTEGER PRIMARY KEY AUTOINCREMENT,
-    PhoneNumber TEXT,
-    UserQuery TEXT,
-    BotResponse TEXT,
-    CreatedDate TEXT,
-    CreatedTime TEXT,
-    "Latency(s)" INTEGER
-    ); """
 
+@lru_cache(maxsize=None)
+def get_log_connection():
+    """
+    One SQLite connection per process for the response logs and cache, opened on first use so a
+    Celery worker never inherits it across fork. WAL with synchronous=NORMAL avoids an fsync per
+    insert, and the logs table is created once here instead of on every message.
+    """
     conn = create_connection(database)
-
     if conn is not None:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
         create_table(conn, sql_create_rag_responses_table)
-        print("Table created successfully.")
-    else:
+        conn.commit()
+    return conn
+
+
+def embed_query(model_name, query):
+    """Normalised embedding of a query for the response cache, or None without a local encoder."""
+    encoder = get_general_question_encoder(model_name) if model_name else None
+    if encoder is None:
+        return None
+    return encoder[0].encode(query, normalize_embeddings=True, convert_to_numpy=True)
+
+
+@lru_cache(maxsize=None)
+def get_response_cache(model_name):
+    # Paraphrases are matched with the general-question encoder, already loaded for is_general_question
+    conn = get_log_connection()
+    return LLMCache(conn, log_db_lock, embed=partial(embed_query, model_name)) if conn is not None else None
+
+
+def append_to_history(session, entry):
+    """
+    Append a turn to a user's history, skipping an exact repeat of the previous entry (e.g. a
+    redelivered webhook). The oldest turns are dropped once the history is past its length
+    limit or HISTORY_TOKEN_BUDGET; the newest turn is always kept.
+    """
+    with session["lock"]:
+        message_history = session["message_history"]
+        if message_history and message_history[-1] == entry:
+            return
+        # Evict explicitly rather than letting the deque do it, so the token count stays in step
+        if len(message_history) == message_history.maxlen:
+            session["history_tokens"] -= entry_tokens(message_history.popleft())
+        message_history.append(entry)
+        session["history_tokens"] += entry_tokens(entry)
+        while session["history_tokens"] > HISTORY_TOKEN_BUDGET and len(message_history) > 1:
+            session["history_tokens"] -= entry_tokens(message_history.popleft())
+
+
+def history_snapshot(session):
+    # Copy taken under the lock so a concurrent append cannot change it while it is serialised
+    with session["lock"]:
+        return list(session["message_history"])
+
+
+def process_whatsapp_message(body, req_time):
+    conn = get_log_connection()
+    if conn is None:
         print("Error! Cannot create the database connection.")
 
     wa_id = body["entry"][0]["changes"][0]["value"]["contacts"][0]["wa_id"]
@@ -362,21 +661,7 @@ def process_whatsapp_message(body, req_time):
     display_number = body["entry"][0]["changes"][0]["value"]["metadata"]["display_phone_number"]
 
     print(f"BODY: {body}")
-    if wa_id not in whatsapp_recepient_question_set.keys():
-        whatsapp_recepient_question_set[wa_id] = \
-            {"message_history": [{"role": "system",
-                                     "content": "You are an helpful assistant that answers all general queries related to"
-                                             " Meghalaya Public Services Delivery Commision using your knowledge base. "
-                                             "Do not answer queries that are not related to Meghalaya Public Services Delivery Commision."}],
-             "previous_messages": []}
-    elif len(whatsapp_recepient_question_set[wa_id]["message_history"]) > 20:
-        whatsapp_recepient_question_set[wa_id].clear()
-        whatsapp_recepient_question_set[wa_id] = \
-            {"message_history": [{"role": "system",
-                                     "content": "You are an helpful assistant that answers all general queries related to"
-                                              " Meghalaya Public Services Delivery Commision using your knowledge base. "
-                                             "Do not answer queries that are not related to Meghalaya Public Services Delivery Commision."}],
-             "previous_messages": []}
+    session = whatsapp_recepient_question_set.get(wa_id)
 
     message = body["entry"][0]["changes"][0]["value"]["messages"][0]
     try:
@@ -386,9 +671,9 @@ def process_whatsapp_message(body, req_time):
             print(
                 f"Display number: {display_number}, Message body: {message_body} and message from {body['entry'][0]['changes'][0]['value']['contacts']}")
 
-            if display_number == '919811294652':
+            if display_number == allowed_display_number:
                 print("*2")
-                whatsapp_recepient_question_set[wa_id]["message_history"].append({"role": "user", "content": message_body})
+                append_to_history(session, {"role": "user", "content": message_body})
 
                 if is_general_question(message_body) == "True":
                     print("*3")
@@ -400,7 +685,7 @@ def process_whatsapp_message(body, req_time):
 
                     data = get_text_message_input(wa_id, msg_to_be_sent)
                     send_message(data)
-                    whatsapp_recepient_question_set[wa_id]["message_history"].append({"role": "system", "content": general_response})
+                    append_to_history(session, {"role": "system", "content": general_response})
                 else: 
                     print("*4")
 
@@ -427,27 +712,25 @@ def process_whatsapp_message(body, req_time):
 
                     
                         response, updated_message_history, resp_time = generate_response(wa_id, message_body, message_type,
-                                                                              whatsapp_recepient_question_set[wa_id]["message_history"], "wp")
+                                                                              history_snapshot(session), "wp")
                         # insert_rag_response(conn, wa_id, message_body, response, "Whatsapp", req_time, resp_time)
                     else:
                         print("*6")
                         response, placeholder, resp_time = generate_response(wa_id, message_body, message_type,
-                                                                              whatsapp_recepient_question_set[wa_id]["message_history"], "wp")
+                                                                              history_snapshot(session), "wp")
                     insert_rag_response(conn, wa_id, message_body, response, "Whatsapp", req_time, resp_time)
                     data = get_text_message_input(wa_id, response)
                     print(f"Output for app.py: {response}")
                     send_message(data)
                     if not message_type == "greeting":
                         for message in updated_message_history:
-                            whatsapp_recepient_question_set[wa_id]["message_history"].append(message)
+                            append_to_history(session, message)
                 
             else:
                 print("*8")
                 print("Request from Phone number is invalid...")
         else:
             print("*9")
-            no_text_response = ("I am here to help you with any form of text queries related to Meghalaya State Public Services Delivery Commission (MSPSDC), "
-                                "please ask me anything in that context and I'd be happy to assist you!")
             translated_reponse = no_text_response
             # translated_reponse = translate(whatsapp_recepient_question_set[wa_id]["message_history"][-1]['content'], no_text_response)
 
@@ -466,25 +749,25 @@ def process_whatsapp_message(body, req_time):
 
 
 
+def seconds_of_day(time_str):
+    t = datetime.time.fromisoformat(time_str)
+    return t.hour * 3600 + t.minute * 60 + t.second + t.microsecond / 1e6
+
+
 def insert_rag_response(connection, user_id, user_query, rag_response, channel, req_time, resp_time):
     print("INSERTING RAG RESPONSE***********")
     """Insert a new row into the rag_responses table with the current UTC datetime."""
     if connection is not None:
         try:
 
-            # Convert time strings to datetime objects
-            req_time = datetime.datetime.strptime(req_time, "%H:%M:%S.%f")
-            resp_time = datetime.datetime.strptime(resp_time, "%H:%M:%S.%f")
-
-            # Calculate the difference (timedelta)
-            time_diff = resp_time - req_time
+            # Latency from the isoformat() time strings; fromisoformat is a C parser, unlike
+            # strptime's regex/locale path. Modulo a day so a reply after midnight stays positive
+            total_seconds = (seconds_of_day(resp_time) - seconds_of_day(req_time)) % 86400
 
-            total_seconds = time_diff.total_seconds()
-
-            # Current UTC datetime
+            # Current local datetime, formatted from its fields directly
             now = datetime.datetime.now()
-            today_str = now.strftime("%d-%m-%Y")
-            current_time_str = now.strftime("%H:%M:%S")
+            today_str = f"{now.day:02d}-{now.month:02d}-{now.year:04d}"
+            current_time_str = f"{now.hour:02d}:{now.minute:02d}:{now.second:02d}"
 
             # formatted_date = created_datetime.strftime("%d-%m-%Y")
 
@@ -499,9 +782,10 @@ def insert_rag_response(connection, user_id, user_query, rag_response, channel,
             data = (user_id, user_query, rag_response, today_str, current_time_str, total_seconds)
 
             # Execute the query
-            cursor = connection.cursor()
-            cursor.execute(query, data)
-            connection.commit()
+            with log_db_lock:
+                cursor = connection.cursor()
+                cursor.execute(query, data)
+                connection.commit()
             print("!"*50)
             print(f"Record inserted successfully into rag_responses table, ID: {cursor.lastrowid}")
             print("!"*50)
@@ -517,17 +801,11 @@ def insert_rag_response(connection, user_id, user_query, rag_response, channel,
 def send_response_to_slack(channel_id, message, user_id):
     # This function would use the Slack API's `chat.postMessage` method to send a response back to the user
     # You need to use your bot's OAuth token to authenticate the request
-    import requests
-    url = "https://slack.com/api/chat.postMessage"
-    headers = {
-        'Authorization': '',
-        'Content-Type': 'application/json'
-    }
     data = {
         'channel': channel_id,
         'text': message
     }
-    response = requests.post(url, headers=headers, json=data)
+    response = http_session.post(SLACK_POST_MESSAGE_URL, headers=SLACK_HEADERS, json=data, timeout=(3, 10))
     if response.status_code == 200:
         print(f"Message successfully sent to {user_id} in channel {channel_id}")
     else:
@@ -538,12 +816,18 @@ def is_valid_whatsapp_message(body):
     """
     Check if the incoming webhook event has a valid WhatsApp message structure.
     """
-    return (
-            body.get("object")
-            and body.get("entry")
-            and body["entry"][0].get("changes")
-            and body["entry"][0]["changes"][0].get("value")
-            and body["entry"][0]["changes"][0]["value"].get("messages")
-            and body["entry"][0]["changes"][0]["value"]["messages"][0]
-    )
+    try:
+        return body["object"] and body["entry"][0]["changes"][0]["value"]["messages"][0]
+    except (KeyError, IndexError, TypeError):
+        return None
+
+
+def get_whatsapp_statuses(body):
+    """
+    Return the statuses list of a WhatsApp status update (sent/delivered/read), or None for any other payload.
+    """
+    try:
+        return body["entry"][0]["changes"][0]["value"]["statuses"]
+    except (KeyError, IndexError, TypeError):
+        return None
 
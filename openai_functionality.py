@@ -1,4 +1,5 @@
 from fastapi import FastAPI, logger
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 import sqlite3
 import pandas as pd
@@ -43,6 +44,9 @@ from langroid.embedding_models.models import SentenceTransformerEmbeddingsConfig
 import warnings
 warnings.filterwarnings('ignore')
 import nltk
+import logging
+
+log = logging.getLogger(__name__)
 
 #nltk.download("punkt")
 import os
@@ -50,12 +54,15 @@ import os
 
 os.environ["TRANSFORMERS_CACHE"] = "/raid/home/ihub1/.cache/huggingface"
 os.environ["HF_HOME"]="/raid/home/ihub1/.cache/huggingface"
-print("nltk path", nltk.data.path)
+log.info("nltk path %s", nltk.data.path)
 nltk.data.path.insert(0, "/raid/home/ihub1/nltk_data")
 nltk.data.path.append("/raid/home/ihub1/nltk_data")
 os.environ['NLTK_DATA'] = '/raid/home/ihub1/nltk_data'
-print("new nltk paht", nltk.data.path)
-nltk.download("punkt")
+log.info("new nltk path %s", nltk.data.path)
+try:
+    nltk.data.find('tokenizers/punkt')
+except LookupError:
+    nltk.download("punkt")
 # nest_asyncio.apply()
 import langroid as lr
 from langroid.mytypes import Document
@@ -90,7 +97,8 @@ role_mapping = {
     'user': 'Human'
 }
 
-app = FastAPI()
+# orjson encodes the query responses (and the history echoed back in them) directly to bytes
+app = FastAPI(default_response_class=ORJSONResponse)
 # MEMORY_KEY = "chat_history"
 # full_prompt = ChatPromptTemplate.from_messages(
 #     [
@@ -132,23 +140,32 @@ def tool_call_html(query):
 
 
 import time
+import threading
 
 
 # from get_unstr_query import get_ans, get_context
 from tmp import get_ans
 from datetime import datetime, timedelta
 
+# handle_query runs on FastAPI's threadpool: get_ans drives one shared langroid agent (and sets
+# the process-wide CUDA device), and the CSV append is a read-modify-write, so each gets a lock
+agent_lock = threading.Lock()
+csv_lock = threading.Lock()
+
 @app.post("/query/")
-async def handle_query(query: Query):
+def handle_query(query: Query):
+    # Plain def on purpose: get_ans is blocking, so FastAPI runs this in its threadpool and the
+    # event loop stays free for other requests; agent_lock keeps the agent calls themselves serial
     chk_resp = None
-    print("in openai_functionality.py")
+    log.debug("in openai_functionality.py")
     all_responses = []
-    response, context = get_ans(query.query)
-    today = datetime.today()
-    yesterday = today - timedelta(days=1)
-    response += "\n_NOTE : This information is provided as of " + today.strftime('%d-%m-%Y') + " 12:00 AM" + "_"
+    with agent_lock:
+        response, context = get_ans(query.query)
+    # One clock read per request for both the note date and the response time
+    now = datetime.now()
+    response += "\n_NOTE : This information is provided as of " + now.strftime('%d-%m-%Y') + " 12:00 AM" + "_"
     all_responses.append({"role": "system", "content": f"RESPONSE BY RAG: {response}"})
-    resp_time = datetime.now().time().isoformat(timespec='milliseconds')
+    resp_time = now.time().isoformat(timespec='milliseconds')
     try:
         data = {
             'question': [query.query],
@@ -163,12 +180,13 @@ async def handle_query(query: Query):
             'response': [response],
             'time' : [resp_time],
         }
-    try:
-        df = pd.read_csv('response_data.csv')
-    except FileNotFoundError:
-        df = pd.DataFrame(columns=['question', 'context', 'response', "time"])
-    df = pd.concat([df, pd.DataFrame(data)], ignore_index=True)
-    df.to_csv('response_data.csv', index=False)
+    with csv_lock:
+        try:
+            df = pd.read_csv('response_data.csv')
+        except FileNotFoundError:
+            df = pd.DataFrame(columns=['question', 'context', 'response', "time"])
+        df = pd.concat([df, pd.DataFrame(data)], ignore_index=True)
+        df.to_csv('response_data.csv', index=False)
     return {"response": response, "responses": all_responses, "response_time": resp_time}
 
 